@@ -0,0 +1,152 @@
+# bench.py
+import argparse
+import json
+import os
+import subprocess
+import sys
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+BENCH_PASSWORD = 'benchmark-password'
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark auth, rate limiting and static routes of onion.py')
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='comma separated account store sizes')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='requests per cheap route (check_auth, static)')
+    parser.add_argument('--auth-requests', type=int, default=50,
+                        help='requests per hashing route (register, login)')
+    parser.add_argument('--rate-limit-hits', type=int, default=500000,
+                        help='limiter hits for the RATE_LIMITS memory run')
+    parser.add_argument('--rate-limit-clients', type=int, default=50000,
+                        help='distinct client addresses for the RATE_LIMITS memory run')
+    parser.add_argument('--cold-starts', type=int, default=5,
+                        help='fresh interpreter runs for the cold start measurement')
+    parser.add_argument('--rate-limit-storage', default=None,
+                        help="RATE_LIMIT_STORAGE used by the app under test (default: the app's own, sqlite)")
+    return parser.parse_args()
+
+def client_ip(n):
+    return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+def report(name, samples):
+    total = sum(samples)
+    print(f"  {name:<18} {len(samples):>7} req  {len(samples) / total:>10.1f} req/s  "
+          f"p50 {percentile(samples, 50) * 1000:>8.3f} ms  p99 {percentile(samples, 99) * 1000:>8.3f} ms")
+
+def fill_accounts(onion, size):
+    salt, password_hash = onion.hash_password(BENCH_PASSWORD)
+    conn = onion.get_db()
+    with conn:
+        conn.execute('DELETE FROM accounts')
+        conn.executemany(
+            'INSERT INTO accounts '
+            '(email, password_hash, salt, algorithm, iterations, ip, useragent, registration_date) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((f"user{i}@bench.example", password_hash, salt, onion.HASH_ALGORITHM, onion.HASH_ITERATIONS,
+              '127.0.0.1', 'bench', '2024-01-01 00:00:00')
+             for i in range(size))
+        )
+
+def run(client, ip_counter, method, path, **kwargs):
+    ip_counter[0] += 1
+    started = time.perf_counter()
+    response = client.open(path, method=method, environ_base={'REMOTE_ADDR': client_ip(ip_counter[0])}, **kwargs)
+    elapsed = time.perf_counter() - started
+    if response.status_code >= 400:
+        raise RuntimeError(f"{method} {path} returned {response.status_code}")
+    return elapsed
+
+def bench_routes(onion, size, args, ip_counter):
+    client = onion.create_app().test_client()
+    fill_accounts(onion, size)
+    print(f"accounts: {size}")
+
+    samples = [run(client, ip_counter, 'POST', '/register',
+                   json={'email': f"new{size}_{i}@bench.example", 'password': BENCH_PASSWORD})
+               for i in range(args.auth_requests)]
+    report('/register', samples)
+
+    samples = [run(client, ip_counter, 'POST', '/login',
+                   json={'email': f"user{random.randrange(size)}@bench.example", 'password': BENCH_PASSWORD})
+               for _ in range(args.auth_requests)]
+    report('/login', samples)
+
+    samples = [run(client, ip_counter, 'GET', '/check_auth') for _ in range(args.requests)]
+    report('/check_auth', samples)
+
+    for path in ('/', '/onion.css', '/onion.js', onion.STATIC_ASSETS['onion.css']['fingerprinted']):
+        samples = [run(client, ip_counter, 'GET', path, headers={'Accept-Encoding': 'gzip'})
+                   for _ in range(args.requests)]
+        report(path if len(path) <= 18 else '/onion.<hash>.css', samples)
+
+def bench_rate_limits(onion, args):
+    onion.RATE_LIMITS.clear()
+    storage = onion.MemoryRateLimitStorage()
+    now = time.time()
+    step = max(args.rate_limit_hits // 10, 1)
+    print(f"RATE_LIMITS: {args.rate_limit_hits} hits from {args.rate_limit_clients} clients")
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    samples = []
+    for i in range(args.rate_limit_hits):
+        key = f"shared:{client_ip(random.randrange(args.rate_limit_clients))}"
+        started = time.perf_counter()
+        storage.hit([(key, 10 ** 9, size) for size in (60, 3600)], now + i * 0.01)
+        samples.append(time.perf_counter() - started)
+        if (i + 1) % step == 0:
+            entries = sum(len(bucket) for bucket in onion.RATE_LIMITS.values())
+            used = tracemalloc.get_traced_memory()[0] - baseline
+            print(f"  after {i + 1:>9} hits  {entries:>7} entries  {used / 1024:>10.1f} KiB  "
+                  f"p50 {statistics.median(samples) * 1e6:>6.2f} us  p99 {percentile(samples, 99) * 1e6:>6.2f} us")
+            samples = []
+    tracemalloc.stop()
+
+COLD_START_SCRIPT = (
+    "import json, time; started = time.perf_counter(); import onion; onion.create_app(); "
+    "timings = dict(onion.STARTUP_TIMINGS, total=time.perf_counter() - started); print(json.dumps(timings))"
+)
+
+def bench_cold_start(workdir, args):
+    if args.cold_starts <= 0:
+        return
+    print(f"cold start: {args.cold_starts} runs")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(args.cold_starts):
+        output = subprocess.run([sys.executable, '-c', COLD_START_SCRIPT], cwd=workdir, env=env,
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output))
+    for phase in runs[0]:
+        values = [run[phase] for run in runs]
+        print(f"  {phase:<18} median {statistics.median(values) * 1000:>8.2f} ms  max {max(values) * 1000:>8.2f} ms")
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix='onion-bench-')
+    os.chdir(workdir)
+    os.environ['BASE_DB'] = os.path.join(workdir, 'base.db')
+    if args.rate_limit_storage is not None:
+        os.environ['RATE_LIMIT_STORAGE'] = args.rate_limit_storage
+    bench_cold_start(workdir, args)
+    import onion
+
+    print(f"rate limit storage: {onion.RATE_LIMIT_STORAGE}")
+    # Client addresses keep counting across sizes so no address is reused
+    # against the persistent limiter state.
+    ip_counter = [0]
+    for size in (int(size) for size in args.sizes.split(',')):
+        bench_routes(onion, size, args, ip_counter)
+    bench_rate_limits(onion, args)
+
+if __name__ == '__main__':
+    main()
@@ -1,78 +1,580 @@
 # onion.py
-from flask import Flask, request, jsonify, session, send_file
+import time
+_import_started = time.perf_counter()
+
+from flask import Flask, Response, request, jsonify, session, abort, g
 import requests
 import uuid
 import csv
+import sqlite3
+import threading
+import queue
 import re
 import hashlib
 import secrets
 import os
+import sys
 import json
-import phonenumbers
+import gzip
+import bisect
+import itertools
 from datetime import datetime
 from functools import wraps
-import time
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 
-limiter = Limiter(
-    get_remote_address,
-    app=app,
-    default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://",
-)
-
 BASE_CSV = 'base.csv'
+BASE_DB = os.environ.get('BASE_DB', 'base.db')
 
+RATE_LIMIT_STORAGE = os.environ.get('RATE_LIMIT_STORAGE', 'sqlite:///ratelimit.db')
 RATE_LIMITS = {}
+RATE_LIMITS_LOCK = threading.Lock()
 MAX_REQUESTS_PER_MINUTE = 10
 MAX_REQUESTS_PER_HOUR = 100
+RATE_LIMIT_MAX_CLIENTS = 100000
+
+HASH_ALGORITHM = 'pbkdf2_sha256'
+HASH_ALGORITHMS = {'pbkdf2_sha256': 'sha256'}
+LEGACY_HASH_ITERATIONS = 100000
+HASH_MIN_ITERATIONS = LEGACY_HASH_ITERATIONS
+HASH_ITERATIONS = int(os.environ.get('HASH_ITERATIONS', LEGACY_HASH_ITERATIONS))
+HASH_TARGET_MS = os.environ.get('HASH_TARGET_MS')
+HASH_REHASH_TOLERANCE = 0.1
+# The hash pool and its queue limit are per process. They are meant for
+# threaded workers (gunicorn --threads N or gthread), where many requests share
+# one pool; with sync workers each process handles one request at a time and
+# the 503 path never triggers. WEB_CONCURRENCY is the number of worker
+# processes, so the pools together use about one thread per CPU.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', max(1, (os.cpu_count() or 2) // WEB_CONCURRENCY)))
+HASH_QUEUE_LIMIT = int(os.environ.get('HASH_QUEUE_LIMIT', HASH_WORKERS * 4))
+
+REGISTER_BATCH_SIZE = 256
+REGISTER_TIMEOUT = 10
+REGISTER_BUSY_TIMEOUT = 5
+
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_ALLOWED_IPS = set(os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(','))
+
+# Metrics are kept per process; each worker exposes its own counters, and
+# every series carries a pid label so scrapes from different workers can be
+# told apart and summed.
+_metrics_lock = threading.Lock()
+ROUTE_LATENCY = {}
+HOT_PATH_LATENCY = {}
+STATUS_COUNTS = {}
+LIMITER_REJECTIONS = {}
+STARTUP_TIMINGS = {}
+
+def observe(histograms, name, value):
+    with _metrics_lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = {'buckets': [0] * (len(METRICS_BUCKETS) + 1), 'sum': 0.0, 'count': 0}
+        histogram['buckets'][bisect.bisect_left(METRICS_BUCKETS, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+def count(counters, key):
+    with _metrics_lock:
+        counters[key] = counters.get(key, 0) + 1
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(HOT_PATH_LATENCY, name, time.perf_counter() - started)
+        return wrapper
+    return decorator
 
-def init_csv():
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    endpoint = request.endpoint or 'unknown'
+    if started is not None:
+        observe(ROUTE_LATENCY, endpoint, time.perf_counter() - started)
+    count(STATUS_COUNTS, (endpoint, response.status_code))
+    return response
+
+def render_histograms(lines, metric, labels, label, histograms):
+    lines.append(f"# TYPE {metric} histogram")
+    for name, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, bucket in zip(METRICS_BUCKETS + ('+Inf',), histogram['buckets']):
+            cumulative += bucket
+            lines.append(f'{metric}_bucket{{{labels},{label}="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{{labels},{label}="{name}"}} {histogram["sum"]}')
+        lines.append(f'{metric}_count{{{labels},{label}="{name}"}} {histogram["count"]}')
+
+def render_metrics():
+    labels = f'pid="{os.getpid()}"'
+    lines = []
+    with _metrics_lock:
+        render_histograms(lines, 'onion_request_duration_seconds', labels, 'endpoint', ROUTE_LATENCY)
+        render_histograms(lines, 'onion_hot_path_duration_seconds', labels, 'name', HOT_PATH_LATENCY)
+        lines.append("# TYPE onion_requests_total counter")
+        for (endpoint, status), value in sorted(STATUS_COUNTS.items()):
+            lines.append(f'onion_requests_total{{{labels},endpoint="{endpoint}",status="{status}"}} {value}')
+        lines.append("# TYPE onion_rate_limit_rejections_total counter")
+        for endpoint, value in sorted(LIMITER_REJECTIONS.items()):
+            lines.append(f'onion_rate_limit_rejections_total{{{labels},endpoint="{endpoint}"}} {value}')
+        lines.append("# TYPE onion_startup_seconds gauge")
+        for phase, value in STARTUP_TIMINGS.items():
+            lines.append(f'onion_startup_seconds{{{labels},phase="{phase}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+def metrics_allowed():
+    if METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if secrets.compare_digest(authorization, f"Bearer {METRICS_TOKEN}"):
+            return True
+    return request.remote_addr in METRICS_ALLOWED_IPS
+
+ACCOUNT_FIELDS = ['email', 'password_hash', 'salt', 'ip', 'useragent', 'registration_date']
+
+_db_local = threading.local()
+
+def get_db():
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(BASE_DB, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        _db_local.conn = conn
+    return conn
+
+def import_csv(conn, path=BASE_CSV):
     try:
-        with open(BASE_CSV, 'r', encoding='utf-8') as file:
+        with open(path, 'r', encoding='utf-8') as file:
             reader = csv.DictReader(file)
-            if 'email' not in reader.fieldnames:
-                raise ValueError("Old CSV format")
-    except (FileNotFoundError, ValueError):
-        with open(BASE_CSV, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.writer(file)
-            writer.writerow(['email', 'password_hash', 'salt', 'ip', 'useragent', 'registration_date'])
-
-init_csv()
-
-def rate_limit(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        ip = request.remote_addr
-        now = time.time()
-        
-        if ip not in RATE_LIMITS:
-            RATE_LIMITS[ip] = {'minute': [], 'hour': []}
-        
-        minute_requests = [req_time for req_time in RATE_LIMITS[ip]['minute'] if now - req_time < 60]
-        hour_requests = [req_time for req_time in RATE_LIMITS[ip]['hour'] if now - req_time < 3600]
-        
-        if len(minute_requests) >= MAX_REQUESTS_PER_MINUTE:
-            return jsonify({'error': 'Слишком много запросов. Попробуйте позже.'}), 429
-        if len(hour_requests) >= MAX_REQUESTS_PER_HOUR:
-            return jsonify({'error': 'Превышен лимит запросов в час.'}), 429
-        
-        RATE_LIMITS[ip]['minute'].append(now)
-        RATE_LIMITS[ip]['hour'].append(now)
-        
-        return func(*args, **kwargs)
-    return wrapper
+            if not reader.fieldnames or 'email' not in reader.fieldnames:
+                return 0
+            rows = (tuple(row.get(field) or '' for field in ACCOUNT_FIELDS) for row in reader if row.get('email'))
+            cursor = conn.executemany(
+                'INSERT OR IGNORE INTO accounts (email, password_hash, salt, ip, useragent, registration_date) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            return cursor.rowcount
+    except FileNotFoundError:
+        return 0
+
+# Uses its own connection so nothing stays open in a master process that is
+# about to fork.
+def init_db():
+    conn = sqlite3.connect(BASE_DB, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    try:
+        _init_db(conn)
+    finally:
+        conn.close()
+
+# Creating the table, migrating its columns and importing base.csv happen in
+# one IMMEDIATE transaction, so when several processes start at once exactly
+# one changes the schema and the others only ever see it complete.
+def _init_db(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'accounts'"
+        ).fetchone()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS accounts ('
+            'email TEXT PRIMARY KEY, '
+            'password_hash TEXT NOT NULL, '
+            'salt TEXT NOT NULL, '
+            'ip TEXT, '
+            'useragent TEXT, '
+            'registration_date TEXT'
+            ')'
+        )
+        # Accounts created before the cost was stored all used the legacy cost.
+        columns = {row['name'] for row in conn.execute('PRAGMA table_info(accounts)')}
+        if 'algorithm' not in columns:
+            conn.execute(f"ALTER TABLE accounts ADD COLUMN algorithm TEXT NOT NULL DEFAULT '{HASH_ALGORITHM}'")
+        if 'iterations' not in columns:
+            conn.execute(
+                f"ALTER TABLE accounts ADD COLUMN iterations INTEGER NOT NULL DEFAULT {LEGACY_HASH_ITERATIONS}"
+            )
+        conn.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        if not exists:
+            import_csv(conn)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+@timed('account_lookup')
+def find_account(email):
+    row = get_db().execute('SELECT * FROM accounts WHERE email = ?', (email,)).fetchone()
+    return dict(row) if row else None
+
+# Registrations go through a single writer thread that drains whatever is
+# pending and commits it as one transaction. INSERT OR IGNORE against the
+# email primary key keeps uniqueness atomic, including within a batch.
+_register_queue = queue.Queue()
+_register_writer = None
+_register_writer_lock = threading.Lock()
+
+class RegisterUnavailable(Exception):
+    pass
+
+def _fail_pending(batch, error):
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(error)
+    while True:
+        try:
+            _, future = _register_queue.get_nowait()
+        except queue.Empty:
+            break
+        if not future.done():
+            future.set_exception(error)
+
+def _write_batches(conn, batch):
+    while True:
+        batch[:] = [_register_queue.get()]
+        while len(batch) < REGISTER_BATCH_SIZE:
+            try:
+                batch.append(_register_queue.get_nowait())
+            except queue.Empty:
+                break
+        # Rows whose caller already gave up are dropped; the rest can no longer
+        # be cancelled, so their callers wait for this commit.
+        batch[:] = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            continue
+        try:
+            with conn:
+                results = [
+                    conn.execute(
+                        'INSERT OR IGNORE INTO accounts '
+                        '(email, password_hash, salt, algorithm, iterations, ip, useragent, registration_date) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        row
+                    ).rowcount == 1
+                    for row, _ in batch
+                ]
+        except sqlite3.Error as e:
+            for _, future in batch:
+                future.set_exception(e)
+            batch.clear()
+            continue
+        for (_, future), created in zip(batch, results):
+            future.set_result(created)
+        batch.clear()
+
+# Any failure outside a single batch (including opening the database) fails
+# everything pending and reconnects, so no caller is left waiting.
+def _register_writer_loop():
+    while True:
+        batch = []
+        try:
+            conn = sqlite3.connect(BASE_DB, timeout=REGISTER_BUSY_TIMEOUT)
+            try:
+                conn.execute('PRAGMA synchronous=FULL')
+                _write_batches(conn, batch)
+            finally:
+                conn.close()
+        except Exception as e:
+            _fail_pending(batch, e)
+            time.sleep(1)
+
+def _start_register_writer():
+    global _register_writer
+    if _register_writer is not None and _register_writer.is_alive():
+        return
+    with _register_writer_lock:
+        if _register_writer is None or not _register_writer.is_alive():
+            _register_writer = threading.Thread(target=_register_writer_loop, name='register-writer', daemon=True)
+            _register_writer.start()
+
+@timed('account_insert')
+def create_account(email, password_hash, salt, algorithm, iterations, ip, useragent):
+    _start_register_writer()
+    future = Future()
+    _register_queue.put((
+        (email, password_hash, salt, algorithm, iterations, ip, useragent,
+         datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        future
+    ))
+    # A 503 is only returned when nothing was written: either the row was
+    # cancelled before the writer picked it up, or its transaction failed.
+    try:
+        try:
+            return future.result(timeout=REGISTER_TIMEOUT)
+        except FutureTimeout:
+            if future.cancel():
+                raise RegisterUnavailable()
+            return future.result()
+    except sqlite3.Error:
+        raise RegisterUnavailable()
+
+RATE_LIMIT_PERIODS = {'minute': 60, 'hour': 3600}
+RATE_LIMIT_MESSAGES = {
+    60: 'Слишком много запросов. Попробуйте позже.',
+    3600: 'Превышен лимит запросов в час.',
+}
+
+def parse_limit(spec):
+    amount, per, period = spec.split()
+    if per != 'per' or period.rstrip('s') not in RATE_LIMIT_PERIODS:
+        raise ValueError(f"Invalid rate limit: {spec}")
+    return int(amount), RATE_LIMIT_PERIODS[period.rstrip('s')]
+
+# Sliding window counter: each window keeps [window_start, current, previous]
+# and the request count is estimated as current + previous weighted by the
+# part of the previous window that still overlaps. Constant memory per client.
+def _window_count(window, now, size):
+    start = now - now % size
+    if window[0] != start:
+        window[2] = window[1] if start - window[0] == size else 0
+        window[1] = 0
+        window[0] = start
+    return window[1] + window[2] * (size - (now - start)) / size
+
+class MemoryRateLimitStorage:
+    def __init__(self, max_clients=RATE_LIMIT_MAX_CLIENTS):
+        self.windows = RATE_LIMITS
+        self.max_clients = max_clients
+
+    def _evict(self, bucket, size, now):
+        while bucket:
+            state = next(iter(bucket.values()))
+            if now - state[3] < 2 * size and len(bucket) <= self.max_clients:
+                break
+            bucket.popitem(last=False)
+
+    def hit(self, checks, now):
+        with RATE_LIMITS_LOCK:
+            states = []
+            for key, amount, size in checks:
+                bucket = self.windows.setdefault(size, OrderedDict())
+                state = bucket.get(key)
+                if state is None:
+                    state = bucket[key] = [0, 0, 0, now]
+                else:
+                    bucket.move_to_end(key)
+                state[3] = now
+                self._evict(bucket, size, now)
+                if _window_count(state, now, size) >= amount:
+                    return size
+                states.append(state)
+            for state in states:
+                state[1] += 1
+        return None
+
+class SQLiteRateLimitStorage:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.hits = itertools.count(1)
 
-def hash_password(password, salt=None):
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rate_limits ('
+                'key TEXT PRIMARY KEY, window_start REAL, current INTEGER, previous INTEGER, expires REAL'
+                ')'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS rate_limits_expires ON rate_limits (expires)')
+            self.local.conn = conn
+        return conn
+
+    def hit(self, checks, now):
+        conn = self.connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = []
+            for key, amount, size in checks:
+                key = f"{size}:{key}"
+                row = conn.execute(
+                    'SELECT window_start, current, previous FROM rate_limits WHERE key = ?', (key,)
+                ).fetchone()
+                state = list(row) if row else [0, 0, 0]
+                if _window_count(state, now, size) >= amount:
+                    conn.execute('ROLLBACK')
+                    return size
+                rows.append((key, state[0], state[1] + 1, state[2], now + 2 * size))
+            conn.executemany('INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?, ?, ?)', rows)
+            if next(self.hits) % 1000 == 0:
+                conn.execute('DELETE FROM rate_limits WHERE expires < ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return None
+
+def create_rate_limit_storage(uri):
+    if uri == 'memory://':
+        return MemoryRateLimitStorage()
+    if uri.startswith('sqlite:///'):
+        return SQLiteRateLimitStorage(uri[len('sqlite:///'):])
+    raise ValueError(f"Unsupported rate limit storage: {uri}")
+
+class RateLimiter:
+    def __init__(self, storage):
+        self.storage = storage
+
+    def limit(self, *limits, shared=False):
+        parsed = [parse_limit(spec) for spec in limits]
+        def decorator(func):
+            scope = func.__name__
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                ip = request.remote_addr
+                checks = [(f"{scope}:{ip}", amount, size) for amount, size in parsed]
+                # Budget shared by every route marked shared=True.
+                if shared:
+                    checks.append((f"shared:{ip}", MAX_REQUESTS_PER_MINUTE, 60))
+                    checks.append((f"shared:{ip}", MAX_REQUESTS_PER_HOUR, 3600))
+                exceeded = self.storage.hit(checks, time.time())
+                if exceeded is not None:
+                    count(LIMITER_REJECTIONS, scope)
+                    response = jsonify({'error': RATE_LIMIT_MESSAGES[exceeded]})
+                    response.headers['Retry-After'] = str(exceeded)
+                    return response, 429
+                return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+limiter = RateLimiter(create_rate_limit_storage(RATE_LIMIT_STORAGE))
+
+@timed('hash_password')
+def hash_password(password, salt=None, iterations=None, algorithm=HASH_ALGORITHM):
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported password hash algorithm: {algorithm}")
     if salt is None:
         salt = secrets.token_hex(16)
-    password_hash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
+    if iterations is None:
+        iterations = HASH_ITERATIONS
+    password_hash = hashlib.pbkdf2_hmac(
+        HASH_ALGORITHMS[algorithm], password.encode('utf-8'), salt.encode('utf-8'), iterations
+    )
     return salt, password_hash.hex()
 
+def _time_pbkdf2(iterations):
+    started = time.perf_counter()
+    hashlib.pbkdf2_hmac(HASH_ALGORITHMS[HASH_ALGORITHM], b'calibration', b'calibration', iterations)
+    return time.perf_counter() - started
+
+# Picks the iteration count that takes about target_ms on this host, never
+# going below the legacy cost.
+def calibrate_hash_iterations(target_ms, sample_iterations=20000, rounds=3):
+    elapsed = min(_time_pbkdf2(sample_iterations) for _ in range(rounds))
+    iterations = int(sample_iterations * target_ms / 1000 / elapsed) // 1000 * 1000
+    return max(iterations, HASH_MIN_ITERATIONS)
+
+# The calibrated cost is stored in base.db together with the target it was
+# calibrated for, so every worker and every restart uses the same value.
+# Only the first process to find no stored value (or a different target)
+# calibrates, under the database write lock.
+def load_hash_cost(target_ms, recalibrate=False):
+    conn = sqlite3.connect(BASE_DB, timeout=30, isolation_level=None)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            stored = dict(conn.execute(
+                "SELECT key, value FROM settings WHERE key IN ('hash_target_ms', 'hash_iterations')"
+            ).fetchall())
+            if not recalibrate and stored.get('hash_target_ms') == str(target_ms) and 'hash_iterations' in stored:
+                conn.execute('COMMIT')
+                return int(stored['hash_iterations'])
+            iterations = calibrate_hash_iterations(target_ms)
+            conn.executemany(
+                'INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                [('hash_target_ms', str(target_ms)), ('hash_iterations', str(iterations))]
+            )
+            conn.execute('COMMIT')
+            return iterations
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.close()
+
+def init_hash_cost():
+    global HASH_ITERATIONS
+    if HASH_TARGET_MS:
+        HASH_ITERATIONS = load_hash_cost(float(HASH_TARGET_MS))
+
+# Calibration is noisy, so accounts within HASH_REHASH_TOLERANCE of the target
+# are left alone rather than rehashed on every small change.
+def needs_rehash(account):
+    if account['algorithm'] != HASH_ALGORITHM:
+        return True
+    return abs(account['iterations'] - HASH_ITERATIONS) > HASH_ITERATIONS * HASH_REHASH_TOLERANCE
+
+class HashQueueFull(Exception):
+    pass
+
+# pbkdf2_hmac releases the GIL, so a thread pool is enough to keep hashing off
+# the request threads; the semaphore caps running + queued jobs.
+_hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='hash')
+_hash_slots = threading.BoundedSemaphore(HASH_QUEUE_LIMIT)
+
+def submit_hash_job(func, *args):
+    if not _hash_slots.acquire(blocking=False):
+        raise HashQueueFull()
+    try:
+        future = _hash_executor.submit(func, *args)
+    except Exception:
+        _hash_slots.release()
+        raise
+    future.add_done_callback(lambda _: _hash_slots.release())
+    return future
+
+def hash_password_bounded(password, salt=None, iterations=None, algorithm=HASH_ALGORITHM):
+    return submit_hash_job(hash_password, password, salt, iterations, algorithm).result()
+
+def _rehash_account(email, password, old_hash, iterations):
+    salt, password_hash = hash_password(password, None, iterations)
+    with get_db() as conn:
+        conn.execute(
+            'UPDATE accounts SET password_hash = ?, salt = ?, algorithm = ?, iterations = ? '
+            'WHERE email = ? AND password_hash = ?',
+            (password_hash, salt, HASH_ALGORITHM, iterations, email, old_hash)
+        )
+
+# Runs in the background after a successful login; when the pool is busy the
+# upgrade is simply retried on the next login.
+def rehash_account(email, password, old_hash):
+    try:
+        submit_hash_job(_rehash_account, email, password, old_hash, HASH_ITERATIONS)
+    except HashQueueFull:
+        pass
+
+@app.errorhandler(HashQueueFull)
+@app.errorhandler(RegisterUnavailable)
+def server_overloaded(error):
+    response = jsonify({'success': False, 'message': 'Сервер перегружен. Попробуйте позже.'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
 def validate_email(email):
     if not email or not isinstance(email, str):
         return False
@@ -243,7 +745,7 @@ def create_search_report(query, data, search_type="phone"):
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>OSINT Report - {sanitize_input(query)}</title>
-    <link rel="stylesheet" href="/onion.css">
+    <link rel="stylesheet" href="{STATIC_ASSETS['onion.css']['fingerprinted']}">
     <script src="https://cdn.jsdelivr.net/npm/particles.js@2.0.0/particles.min.js"></script>
     <style>
         .report-container {{
@@ -577,24 +1079,127 @@ def create_search_report(query, data, search_type="phone"):
 """
     return html_content
 
+STATIC_ASSETS = {}
+
+def load_asset(name, mimetype, body=None):
+    if body is None:
+        with open(os.path.join(app.root_path, name), 'rb') as file:
+            body = file.read()
+    digest = hashlib.sha256(body).hexdigest()[:16]
+    variants = {'identity': body, 'gzip': gzip.compress(body, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=11)
+    stem, ext = os.path.splitext(name)
+    STATIC_ASSETS[name] = {
+        'mimetype': mimetype,
+        'digest': digest,
+        'variants': variants,
+        'fingerprinted': f"/{stem}.{digest}{ext}",
+    }
+    return STATIC_ASSETS[name]
+
+def init_assets():
+    css = load_asset('onion.css', 'text/css')
+    js = load_asset('onion.js', 'application/javascript')
+    with open(os.path.join(app.root_path, 'onion.html'), 'r', encoding='utf-8') as file:
+        html = file.read()
+    html = html.replace('href="/onion.css"', f'href="{css["fingerprinted"]}"')
+    html = html.replace('src="/onion.js"', f'src="{js["fingerprinted"]}"')
+    load_asset('onion.html', 'text/html', html.encode('utf-8'))
+
+_initialized = False
+_init_lock = threading.Lock()
+
+# Application factory. Storage, asset and hash cost setup run once per
+# process: before forking when the server preloads the app (for example
+# gunicorn --preload 'onion:create_app()'), so workers inherit the results,
+# or otherwise on each worker's first request. The latter is safe with many
+# workers: schema changes, the CSV import and hash calibration each take the
+# base.db write lock, so only one process does them and the rest wait and
+# reuse the result. Running 'python -c "import onion; onion.create_app()"'
+# once before starting the workers keeps that work off the first requests.
+def create_app():
+    global _initialized
+    if _initialized:
+        return app
+    with _init_lock:
+        if not _initialized:
+            started = time.perf_counter()
+            for phase, init in (('init_db', init_db), ('init_assets', init_assets), ('init_hash_cost', init_hash_cost)):
+                phase_started = time.perf_counter()
+                init()
+                STARTUP_TIMINGS[phase] = time.perf_counter() - phase_started
+            STARTUP_TIMINGS['create_app'] = time.perf_counter() - started
+            _initialized = True
+    return app
+
+class InitFailed(Exception):
+    pass
+
+app.register_error_handler(InitFailed, server_overloaded)
+
+# A failed first-use setup is retried on the next request.
+@app.before_request
+def ensure_initialized():
+    if not _initialized:
+        try:
+            create_app()
+        except sqlite3.Error:
+            raise InitFailed()
+
+@timed('static_asset')
+def serve_asset(name, immutable=False):
+    asset = STATIC_ASSETS[name]
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in asset['variants'] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    etag = asset['digest'] if encoding == 'identity' else f"{asset['digest']}-{encoding}"
+    
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset['variants'][encoding], mimetype=asset['mimetype'])
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if immutable else 'no-cache'
+    return response
+
 @app.route('/')
 @limiter.limit("10 per minute")
 def index():
-    return send_file('onion.html')
+    return serve_asset('onion.html')
 
 @app.route('/onion.css')
 @limiter.limit("20 per minute")
 def serve_css():
-    return send_file('onion.css', mimetype='text/css')
+    return serve_asset('onion.css')
 
 @app.route('/onion.js')
 @limiter.limit("20 per minute")
 def serve_js():
-    return send_file('onion.js', mimetype='application/javascript')
+    return serve_asset('onion.js')
+
+# Fingerprinted URLs referenced from onion.html. The content never changes
+# under a given URL, so browsers keep them for a year and never revalidate.
+@app.route('/onion.<digest>.<ext>')
+def serve_fingerprinted(digest, ext):
+    asset = STATIC_ASSETS.get(f"onion.{ext}")
+    if asset is None or ext == 'html' or asset['digest'] != digest:
+        abort(404)
+    return serve_asset(f"onion.{ext}", immutable=True)
+
+@app.route('/metrics')
+def metrics():
+    if not metrics_allowed():
+        abort(403)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/register', methods=['POST'])
-@limiter.limit("5 per minute")
-@rate_limit
+@limiter.limit("5 per minute", shared=True)
 def register():
     data = request.get_json()
     if not data:
@@ -609,31 +1214,21 @@ def register():
     if len(password) < 6:
         return jsonify({'success': False, 'message': 'Пароль должен содержать минимум 6 символов'})
     
-    try:
-        with open(BASE_CSV, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if row.get('email') == email:
-                    return jsonify({'success': False, 'message': 'Пользователь с таким email уже существует'})
-    except FileNotFoundError:
-        pass
+    if find_account(email):
+        return jsonify({'success': False, 'message': 'Пользователь с таким email уже существует'})
     
-    salt, password_hash = hash_password(password)
-    with open(BASE_CSV, 'a', newline='', encoding='utf-8') as file:
-        writer = csv.writer(file)
-        writer.writerow([
-            email, password_hash, salt, 
-            request.remote_addr, request.headers.get('User-Agent', ''),
-            datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        ])
+    iterations = HASH_ITERATIONS
+    salt, password_hash = hash_password_bounded(password, None, iterations)
+    if not create_account(email, password_hash, salt, HASH_ALGORITHM, iterations,
+                          request.remote_addr, request.headers.get('User-Agent', '')):
+        return jsonify({'success': False, 'message': 'Пользователь с таким email уже существует'})
     
     session['user_id'] = str(uuid.uuid4())
     session['email'] = email
     return jsonify({'success': True, 'message': 'Регистрация успешна!'})
 
 @app.route('/login', methods=['POST'])
-@limiter.limit("5 per minute")
-@rate_limit
+@limiter.limit("5 per minute", shared=True)
 def login():
     data = request.get_json()
     if not data:
@@ -645,19 +1240,18 @@ def login():
     if not validate_email(email):
         return jsonify({'success': False, 'message': 'Неверный формат email адреса'})
     
-    try:
-        with open(BASE_CSV, 'r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if row.get('email') == email:
-                    _, calculated_hash = hash_password(password, row.get('salt'))
-                    if secrets.compare_digest(row.get('password_hash', ''), calculated_hash):
-                        session['user_id'] = str(uuid.uuid4())
-                        session['email'] = email
-                        return jsonify({'success': True, 'message': 'Вход выполнен!'})
-                    return jsonify({'success': False, 'message': 'Неверный пароль'})
-    except FileNotFoundError:
-        pass
+    account = find_account(email)
+    if account:
+        _, calculated_hash = hash_password_bounded(
+            password, account['salt'], account['iterations'], account['algorithm']
+        )
+        if secrets.compare_digest(account['password_hash'], calculated_hash):
+            if needs_rehash(account):
+                rehash_account(email, password, account['password_hash'])
+            session['user_id'] = str(uuid.uuid4())
+            session['email'] = email
+            return jsonify({'success': True, 'message': 'Вход выполнен!'})
+        return jsonify({'success': False, 'message': 'Неверный пароль'})
     
     return jsonify({'success': False, 'message': 'Пользователь не найден'})
 
@@ -680,8 +1274,7 @@ def get_user_info():
     return jsonify({'email': 'Гость'})
 
 @app.route('/search_<search_type>')
-@limiter.limit("10 per minute")
-@rate_limit
+@limiter.limit("10 per minute", shared=True)
 def search(search_type):
     if 'user_id' not in session:
         return jsonify({'error': 'Требуется авторизация'}), 403
@@ -775,5 +1368,11 @@ def search(search_type):
     except Exception as e:
         return jsonify({'error': f'Внутренняя ошибка: {str(e)}'}), 500
 
+STARTUP_TIMINGS['module'] = time.perf_counter() - _import_started
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    if len(sys.argv) == 3 and sys.argv[1] == '--calibrate':
+        init_db()
+        print(load_hash_cost(float(sys.argv[2]), recalibrate=True))
+    else:
+        create_app().run(host='0.0.0.0', port=5000, debug=True)